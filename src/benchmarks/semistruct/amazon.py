@@ -1,19 +1,40 @@
 import os
 import os.path as osp
 import gzip
+import io
+import ast
+import functools
+import multiprocessing
 import pickle
-import json
 import torch
 import pandas as pd
 import numpy as np
 from tqdm import tqdm
 import gdown
 import zipfile
+from collections import OrderedDict
 from ogb.utils.url import download_url
 from src.benchmarks.semistruct.knowledge_base import SemiStructureKB
 from src.tools.process_text import clean_data, compact_text
-from src.tools.node import df_row_to_dict, Node, register_node
+from src.tools.node import Node, register_node
 from src.tools.io import save_files, load_files
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+
+# characters trimmed from both ends of raw brand names
+BRAND_STRIP_CHARS = " \".*+,-_!@#$%^&*();\\/|<>\'\t\n\r\\"
+
+
+@functools.lru_cache(maxsize=4)
+def load_cached_graph(cache_path):
+    # Keep loaded graphs in memory so that later instances in the same process load instantly.
+    # All instances built from the same cache_path share the returned dicts, so they should be
+    # treated as read-only (ranking reviews is the only, idempotent, in-place change). Up to
+    # four graphs stay alive for the whole process; call load_cached_graph.cache_clear() to free them.
+    return load_files(cache_path)
 
 
 class AmazonSemiStruct(SemiStructureKB):
@@ -53,6 +74,10 @@ class AmazonSemiStruct(SemiStructureKB):
     node_attr_dict = {'product': ['title', 'dimensions', 'weight', 'description', 'features', 'reviews', 'Q&A'],
                        'brand': ['brand_name']}
     processed_url = 'https://drive.google.com/uc?id=1_NlQdMR9thVAZb5Jni9E-ukMeq2VWOvl'
+    # maximum number of nodes kept by __getitem__, least recently used ones are dropped first
+    node_cache_size = 65536
+    # maximum number of (node, relation) neighbor sets kept by _neighbor_set
+    neighbor_cache_size = 65536
 
     def __init__(self, 
                  root,
@@ -60,7 +85,8 @@ class AmazonSemiStruct(SemiStructureKB):
                  meta_link_types=['brand'],
                  max_entries=25,
                  indirected=True,
-                 download_processed=True):
+                 download_processed=True,
+                 num_read_processes=4):
         '''
             Args: 
                 root (str): root directory to store the data
@@ -71,10 +97,16 @@ class AmazonSemiStruct(SemiStructureKB):
                                         to corresponding nodes
                 max_entries (int): maximum number of review & qa entries to show in the description
                 indirected (bool): make the graph indirected
+                num_read_processes (int): number of processes used to read the raw files when processing 
+                                          from scratch, each holding a whole category in memory; 
+                                          use 1 to read them sequentially
         '''
 
         self.root = root
         self.max_entries = max_entries 
+        self.num_read_processes = num_read_processes
+        self._node_cache = OrderedDict()
+        self._neighbor_cache = OrderedDict()
         self.raw_data_dir = osp.join(root, 'raw')
         self.processed_data_dir = osp.join(root, 'processed')
         os.makedirs(self.raw_data_dir, exist_ok=True)
@@ -95,7 +127,9 @@ class AmazonSemiStruct(SemiStructureKB):
 
         if not (cache_path is None) and osp.exists(cache_path):
             print(f'Load cached graph with meta link types {meta_link_types}')
-            processed_data = load_files(cache_path)
+            processed_data = load_cached_graph(cache_path)
+            # reviews in previously processed/downloaded files may not be ranked yet
+            rank_reviews(processed_data['node_info'])
         else:
             processed_data = self._process_raw(categories)
             if meta_link_types: 
@@ -105,13 +139,19 @@ class AmazonSemiStruct(SemiStructureKB):
     
     def __getitem__(self, idx):
         idx = int(idx)
+        if idx in self._node_cache:
+            self._node_cache.move_to_end(idx)
+            return self._node_cache[idx]
         node_info = self.node_info[idx]
-        try:
-            dimensions, weight = node.details.dictionary.product_dimensions.split(' ; ')
-            node_info['dimensions'], node_info['weight'] = dimensions, weight
-        except: pass
         node = Node()
         register_node(node, node_info)
+        try:
+            dimensions, weight = node.details.product_dimensions.split(' ; ')
+            node.dimensions, node.weight = dimensions, weight
+        except: pass
+        self._node_cache[idx] = node
+        if len(self._node_cache) > self.node_cache_size:
+            self._node_cache.popitem(last=False)
         return node
         
     def get_chunk_info(self, idx, attribute):
@@ -130,10 +170,7 @@ class AmazonSemiStruct(SemiStructureKB):
         elif 'review' in attribute:
             chunk = ''
             if len(node_attr):
-                scores = [0 if pd.isnull(review['vote']) else int(review['vote'].replace(",","")) for review in node_attr]
-                ranks = np.argsort(-np.array(scores))
-                for idx, review_idx in enumerate(ranks):
-                    review = node_attr[review_idx]
+                for idx, review in enumerate(node_attr):
                     chunk += 'The review \"' + str(review['summary']) + '\"'
                     chunk += 'states that \"' + str(review['reviewText']) + '\". '
                     if idx > self.max_entries: break
@@ -162,52 +199,48 @@ class AmazonSemiStruct(SemiStructureKB):
             return f'brand name: {self[idx].brand_name}'
         
         node = self[idx]
-        doc = f'- product: {node.title}\n'
+        parts = [f'- product: {node.title}\n']
         if hasattr(node, 'brand'):
-            doc += f'- brand: {node.brand}\n'
+            parts.append(f'- brand: {node.brand}\n')
+        # NOTE: this lookup never matches, so documents have no dimensions/weight lines. It is kept
+        # as is since using node.dimensions/node.weight would change the documents behind the
+        # published embeddings.
         try:
             dimensions, weight = node.details.dictionary.product_dimensions.split(' ; ')
-            doc += (f'- dimensions: {dimensions}\n'
-                    f'- weight: {weight}\n')
+            parts.append(f'- dimensions: {dimensions}\n'
+                         f'- weight: {weight}\n')
         except: pass
         if len(node.description):
             description = " ".join(node.description).strip(" ")
             if len(description) > 0:
-                doc += f'- description: {description}\n'
+                parts.append(f'- description: {description}\n')
         
-        feature_text = f'- features: \n'
         if len(node.feature):
+            parts.append('- features: \n')
             for feature_idx, feature in enumerate(node.feature):
                 if feature == '': continue
                 if 'asin' in feature.lower(): continue
-                feature_text += (f'#{feature_idx + 1}: {feature}\n')
-        else: feature_text = ''
+                parts.append(f'#{feature_idx + 1}: {feature}\n')
         
         if len(node.review):
-            review_text = f'- reviews: \n'
-            scores = [0 if pd.isnull(review['vote']) else int(review['vote'].replace(",","")) for review in node.review]
-            ranks = np.argsort(-np.array(scores))
-            for i, review_idx in enumerate(ranks):
-                review = node.review[review_idx]
-                review_text += (f'#{review_idx + 1}:\n'
-                                f'summary: {review["summary"]}\n'
-                                f'text: "{review["reviewText"]}"\n')
+            parts.append('- reviews: \n')
+            for i, review in enumerate(node.review):
+                parts.append(f'#{review["position"] + 1}:\n'
+                             f'summary: {review["summary"]}\n'
+                             f'text: "{review["reviewText"]}"\n')
                 if i > self.max_entries: break
-        else: review_text = ''
         
         if len(node.qa):
-            qa_text = f'- Q&A: \n'
+            parts.append('- Q&A: \n')
             for qa_idx, qa in enumerate(node.qa):
-                qa_text += (f'#{qa_idx + 1}:\n'
-                            f'question: "{qa["question"]}"\n'
-                            f'answer: "{qa["answer"]}"\n')
+                parts.append(f'#{qa_idx + 1}:\n'
+                             f'question: "{qa["question"]}"\n'
+                             f'answer: "{qa["answer"]}"\n')
                 if qa_idx > self.max_entries: break
-        else: qa_text = ''
-        
-        doc += feature_text + review_text + qa_text
         
         if add_rel:
-            doc += self.get_rel_info(idx)
+            parts.append(self.get_rel_info(idx))
+        doc = ''.join(parts)
         if compact: 
             doc = compact_text(doc)
         return doc
@@ -219,17 +252,14 @@ class AmazonSemiStruct(SemiStructureKB):
         n_also_view = self.get_neighbor_nodes(idx, 'also_view')
         n_has_brand = self.get_neighbor_nodes(idx, 'has_brand')
 
-        str_also_buy = [f"#{idx + 1}: " + self[i].title + '\n' for idx, i in enumerate(n_also_buy)]
-        str_also_view = [f"#{idx + 1}: " + self[i].title  + '\n' for idx, i in enumerate(n_also_view)]
+        # read the titles from node_info directly rather than building nodes
+        node_info = self.node_info
+        str_also_buy = ''.join(f"#{j + 1}: {node_info[i].get('title', '')}\n" for j, i in enumerate(n_also_buy))
+        str_also_view = ''.join(f"#{j + 1}: {node_info[i].get('title', '')}\n" for j, i in enumerate(n_also_view))
         
-        if len(str_also_buy) == 0: str_also_buy = ''
-        if len(str_also_view) == 0: str_also_view = ''
         str_has_brand = ''
         if len(n_has_brand): 
-            str_has_brand = f'  brand: {self[n_has_brand[0]].brand_name}\n'
-            
-        str_also_buy = ''.join(str_also_buy)
-        str_also_view = ''.join(str_also_view)
+            str_has_brand = f"  brand: {node_info[n_has_brand[0]]['brand_name']}\n"
 
         if len(str_also_buy):
             doc += f'  products also purchased: \n{str_also_buy}'
@@ -253,6 +283,8 @@ class AmazonSemiStruct(SemiStructureKB):
         if osp.exists(osp.join(self.processed_data_dir, 'node_info.pkl')):
             print(f'Load processed data from {self.processed_data_dir}')
             loaded_files = load_files(self.processed_data_dir)
+            # reviews in previously processed/downloaded files may not be ranked yet
+            rank_reviews(loaded_files['node_info'])
             loaded_files.update(
                 {'node_types': torch.zeros(len(loaded_files['node_info'])),
                  'node_type_dict': {0: 'product'}})
@@ -269,19 +301,33 @@ class AmazonSemiStruct(SemiStructureKB):
             
         if not osp.exists(osp.join(self.processed_data_dir, 'node_info.pkl')):
             print('Loading data... It might take a while')
+            review_categories, qa_categories = list(review_categories), list(qa_categories)
+            qa_paths = [osp.join(self.raw_data_dir, f'qa_{category}.json.gz') for category in qa_categories]
+            review_paths = [osp.join(self.raw_data_dir, f'{category}.json.gz') for category in review_categories]
+            meta_paths = [osp.join(self.raw_data_dir, f'meta_{category}.json.gz') for category in review_categories]
+            processes = min(self.num_read_processes, 
+                            len(qa_paths) + len(review_paths) + len(meta_paths), 
+                            os.cpu_count() or 1)
+            if processes > 1:
+                # the files are independent, so read them in parallel
+                with multiprocessing.Pool(processes=processes) as pool:
+                    qa_results = pool.map_async(read_qa, qa_paths)
+                    review_results = pool.map_async(read_review, review_paths)
+                    meta_results = pool.map_async(read_review, meta_paths)
+                    qa_df_lst, review_df_lst, meta_df_lst = qa_results.get(), review_results.get(), meta_results.get()
+            else:
+                qa_df_lst = [read_qa(path) for path in qa_paths]
+                review_df_lst = [read_review(path) for path in review_paths]
+                meta_df_lst = [read_review(path) for path in meta_paths]
+
             # read amazon QA data
-            df_qa = pd.concat([read_qa(osp.join(self.raw_data_dir, f'qa_{category}.json.gz'))
-                               for category in qa_categories])[['asin'] + self.qa_columns]
+            df_qa = pd.concat(qa_df_lst)[['asin'] + self.qa_columns]
             
             # read amazon review data
-            df_review = pd.concat([read_review(osp.join(self.raw_data_dir, f'{category}.json.gz')) 
-                                   for category in review_categories])[['asin'] + self.review_columns]
+            df_review = pd.concat(review_df_lst)[['asin'] + self.review_columns]
             # read amazon meta data from amazon review & amazon kdd
-            meta_df_lst = []
-            for category in review_categories:
-                cat_review = read_review(osp.join(self.raw_data_dir, f'meta_{category}.json.gz'))
+            for category, cat_review in zip(review_categories, meta_df_lst):
                 cat_review.insert(0, 'global_category', category.replace('_', ' '))
-                meta_df_lst.append(cat_review)
             df_ucsd_meta = pd.concat(meta_df_lst)
             
             print('Preprocessing data...')
@@ -295,13 +341,16 @@ class AmazonSemiStruct(SemiStructureKB):
             # Filer items with both meta and review data
             df_qa_reduced = df_qa[df_qa['asin'].isin(unique_asin)]
             df_review_reduced = df_review[df_review['asin'].isin(unique_asin)]
+            # parse the vote counts, e.g., "1,234", once for all reviews
+            vote_int = pd.to_numeric(df_review_reduced['vote'].astype(str).str.replace(',', '', regex=False), 
+                                     errors='coerce').fillna(0).astype(np.int64)
+            df_review_reduced = df_review_reduced.assign(vote_int=vote_int)
             df_meta_reduced = df_meta[df_meta['asin'].isin(unique_asin)].reset_index()
             
             def get_map(df):
-                asin2id, id2asin = {}, {}
-                for idx in range(len(df)):
-                    asin2id[df['asin'][idx]] = idx
-                    id2asin[idx] = df['asin'][idx]
+                asins = df['asin'].to_numpy().tolist()
+                asin2id = dict(zip(asins, range(len(asins))))
+                id2asin = dict(enumerate(asins))
                 return asin2id, id2asin
 
             print('Construct node info and graph...')
@@ -341,13 +390,14 @@ class AmazonSemiStruct(SemiStructureKB):
             cur_n_nodes = len(node_info)
             node_type_dict[n_n_types + i] = link_type
             edge_type_dict[n_e_types + i] = "has_" + link_type
-            unique = np.unique(values)
-            for j, unique_j in enumerate(unique):
+            unique, inverse = np.unique(values, return_inverse=True)
+            for j, unique_j in enumerate(unique.tolist()):
                 node_info[cur_n_nodes + j] = {link_type + '_name': unique_j}
-                ids = indices[np.array(values == unique_j)]
-                edge_index[0].extend(list(ids))
-                edge_index[1].extend([cur_n_nodes + j for _ in range(len(ids))])
-                edge_types.extend([i + n_e_types for _ in range(len(ids))])
+            # group the node indices by value in one pass, keeping the index order within each group
+            order = np.argsort(inverse, kind='stable')
+            edge_index[0].extend(indices[order].tolist())
+            edge_index[1].extend((cur_n_nodes + inverse[order]).tolist())
+            edge_types.extend([i + n_e_types] * len(order))
             node_types.extend([n_n_types + i for _ in range(len(unique))])
         edge_index = torch.LongTensor(edge_index)
         edge_types = torch.LongTensor(edge_types)
@@ -364,15 +414,15 @@ class AmazonSemiStruct(SemiStructureKB):
         return files
     
     def _process_brand(self, brand):
-        brand = brand.strip(" \".*+,-_!@#$%^&*();\/|<>\'\t\n\r\\")
-        if len(brand) > 3 and brand[:3] == 'by ':
+        brand = brand.strip(BRAND_STRIP_CHARS)
+        if len(brand) > 3 and brand.startswith('by '):
             brand = brand[3:]
-        if len(brand) > 4 and brand[-4:] == '.com':
+        if len(brand) > 4 and brand.endswith('.com'):
             brand = brand[:-4]
-        if len(brand) > 4 and brand[:4] == 'www.':
+        if len(brand) > 4 and brand.startswith('www.'):
             brand = brand[4:]
         if len(brand) > 100: 
-            brand = brand.split(' ')[0]
+            brand = brand.split(' ', 1)[0]
         return brand
     
     def construct_raw_node_info(self, df_meta, df_review, df_qa):
@@ -382,46 +432,51 @@ class AmazonSemiStruct(SemiStructureKB):
             node_info[idx]['review'] = []
             node_info[idx]['qa'] = []
         
-        for i in tqdm(range(len(df_meta))):
-            df_meta_i = df_meta.iloc[i]
-            asin = df_meta_i['asin']
+        # clean the meta data column by column rather than cell by cell
+        cleaned = {column: df_meta[column].map(clean_data).to_numpy(dtype=object) 
+                   for column in self.meta_columns}
+        for i, asin in enumerate(tqdm(df_meta['asin'].to_numpy())):
             idx = self.asin2id[asin]
             for column in self.meta_columns:
                 if column == 'brand':
-                    brand = self._process_brand(clean_data(df_meta_i[column]))
+                    brand = self._process_brand(cleaned[column][i])
                     if len(brand) > 1:
                         node_info[idx]['brand'] = brand
                 else:
-                    node_info[idx][column] = clean_data(df_meta_i[column])
+                    node_info[idx][column] = cleaned[column][i]
                         
         for name, df in zip(['review', 'qa'], [df_review, df_qa]):
-            for i in tqdm(range(len(df))):
-                df_i = df.iloc[i]
-                asin = df_i['asin']
-                idx = self.asin2id[asin]
-                node_info[idx][name].append(
-                    df_row_to_dict(df_i, colunm_names=self.review_columns \
-                                   if name == 'review' else self.qa_columns))
+            column_names = self.review_columns + ['vote_int'] if name == 'review' else self.qa_columns
+            records = df[column_names].to_dict('records')
+            for asin, record in tqdm(zip(df['asin'].tolist(), records), total=len(records)):
+                node_info[self.asin2id[asin]][name].append(record)
+        rank_reviews(node_info)
         return node_info
 
     def create_raw_product_graph(self, df, columns):
-        edge_types = []
-        edge_index = [[], []]
-        for idx in range(len(df)):
-            out_node = self.asin2id[df['asin'].iloc[idx]]
-            for edge_type_id, edge_type in enumerate(columns):
-                in_nodes = []
-                if not isinstance(df[edge_type].iloc[idx], list):
+        asin2id = self.asin2id
+        asin_arr = df['asin'].to_numpy()
+        col_arrs = [df[edge_type].to_numpy(dtype=object) for edge_type in columns]
+        # allocate for all listed neighbors, then trim those not in the graph
+        n_max = sum(len(neighbors) for col_arr in col_arrs for neighbors in col_arr if isinstance(neighbors, list))
+        src = np.empty(n_max, dtype=np.int64)
+        dst = np.empty(n_max, dtype=np.int64)
+        edge_types = np.empty(n_max, dtype=np.int64)
+        n_edges = 0
+        for idx, out_asin in enumerate(asin_arr):
+            out_node = asin2id[out_asin]
+            for edge_type_id, col_arr in enumerate(col_arrs):
+                neighbors = col_arr[idx]
+                if not isinstance(neighbors, list):
                     continue
-                for i in df[edge_type].iloc[idx]:
-                    try:
-                        in_nodes.append(self.asin2id[i])
-                    except KeyError:
-                        continue
-                edge_types.extend([edge_type_id for _ in range(len(in_nodes))])
-                edge_index[0].extend([out_node for _ in range(len(in_nodes))])
-                edge_index[1].extend(in_nodes)
-        return torch.LongTensor(edge_index), torch.LongTensor(edge_types)
+                in_nodes = [asin2id[i] for i in neighbors if i in asin2id]
+                end = n_edges + len(in_nodes)
+                src[n_edges:end] = out_node
+                dst[n_edges:end] = in_nodes
+                edge_types[n_edges:end] = edge_type_id
+                n_edges = end
+        edge_index = np.stack([src[:n_edges], dst[:n_edges]])
+        return torch.from_numpy(edge_index), torch.from_numpy(edge_types[:n_edges].copy())
 
     def has_brand(self, idx, brand):
         try: 
@@ -432,47 +487,87 @@ class AmazonSemiStruct(SemiStructureKB):
         except:
             return False
 
+    def _neighbor_set(self, idx, edge_type):
+        key = (int(idx), edge_type)
+        if key in self._neighbor_cache:
+            self._neighbor_cache.move_to_end(key)
+            return self._neighbor_cache[key]
+        neighbors = frozenset(self.get_neighbor_nodes(*key))
+        self._neighbor_cache[key] = neighbors
+        if len(self._neighbor_cache) > self.neighbor_cache_size:
+            self._neighbor_cache.popitem(last=False)
+        return neighbors
+
     def has_also_buy(self, idx, also_buy_item):
         try: 
-            also_buy_lst = self.get_neighbor_nodes(idx, 'also_buy') 
-            return also_buy_item in also_buy_lst
+            return int(also_buy_item) in self._neighbor_set(idx, 'also_buy')
         except:
             return False
         
     def has_also_view(self, idx, also_view_item):
         try: 
-            also_buy_lst = self.get_neighbor_nodes(idx, 'also_view') 
-            return also_view_item in also_buy_lst
+            return int(also_view_item) in self._neighbor_set(idx, 'also_view')
         except:
             return False
+
+
+def review_score(review):
+    if 'vote_int' in review:
+        return review['vote_int']
+    # reviews processed without the parsed vote counts
+    return 0 if pd.isnull(review['vote']) else int(review['vote'].replace(',', ''))
+
+
+def rank_reviews(node_info):
+    '''
+    Reorder the reviews of each node in place by descending number of votes and record
+    each review's original position under 'position'. Nodes that are already ranked are skipped.
+    Args:
+        node_info (dict): node info as built by AmazonSemiStruct.construct_raw_node_info
+    Return:
+        bool: whether any node was reranked
+    '''
+    changed = False
+    for node_info_i in node_info.values():
+        reviews = node_info_i.get('review')
+        if not reviews or 'position' in reviews[0]:
+            continue
+        # same (unstable) argsort as the documents were originally built with
+        ranks = np.argsort(-np.array([review_score(review) for review in reviews]))
+        for position, review in enumerate(reviews):
+            review['position'] = position
+        node_info_i['review'] = [reviews[i] for i in ranks]
+        changed = True
+    return changed
+
     
+# read gzipped files line by line
+def read_gzip_lines(path, buffer_size=1 << 20):
+  # read through a large buffer instead of the default 8KB one
+  with gzip.open(path, 'rb') as raw, io.BufferedReader(raw, buffer_size=buffer_size) as g:
+    for l in g:
+      yield l
+
+
 # read review files
 def read_review(path):
   def parse(path):
-    g = gzip.open(path, 'rb')
-    for l in g:
-      yield json.loads(l)
+    for l in read_gzip_lines(path):
+      yield json_loads(l)
   def getDF(path):
-    i = 0
-    df = {}
-    for d in parse(path):
-      df[i] = d
-      i += 1
-    return pd.DataFrame.from_dict(df, orient='index')
+    return pd.DataFrame(list(parse(path)))
   return getDF(path)
 
 
 # read qa files
 def read_qa(path):
   def parse(path):
-    g = gzip.open(path, 'rb')
-    for l in g:
-      yield eval(l)
+    for l in read_gzip_lines(path):
+      try:
+        yield json_loads(l)
+      except ValueError:
+        # the amazon QA files are mostly python dict literals rather than strict json
+        yield ast.literal_eval(l.decode('utf-8'))
   def getDF(path):
-    i = 0
-    df = {}
-    for d in parse(path):
-      df[i] = d
-      i += 1
-    return pd.DataFrame.from_dict(df, orient='index')
+    return pd.DataFrame(list(parse(path)))
   return getDF(path)
@@ -1,5 +1,6 @@
 import os
 import os.path as osp
+import mmap
 import pickle
 import torch
 import json
@@ -33,12 +34,24 @@ def write_to_file(file_path, content):
         raise NotImplementedError(f'File type not supported: {file_path}')
 
 
+def load_pickle(file_path):
+    '''
+    Load a pickle file through a read-only memory map, which avoids
+    the overhead of reading large files through a buffered stream.
+    '''
+    with open(file_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return pickle.load(f)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            return pickle.loads(m)
+
+
 def save_files(save_path, **kwargs):
     os.makedirs(save_path, exist_ok=True)
     for key, value in kwargs.items():
         if isinstance(value, dict):
             with open(osp.join(save_path, f'{key}.pkl'), 'wb') as f:
-                pickle.dump(value, f)
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
         elif isinstance(value, torch.Tensor):
             torch.save(value, osp.join(save_path, f'{key}.pt'))
         else:
@@ -51,8 +64,7 @@ def load_files(save_path):
         if os.path.isdir(osp.join(save_path, file)): 
             continue
         if file.endswith('.pkl'):
-            with open(osp.join(save_path, file), 'rb') as f:
-                loaded_dict[file.split('.')[0]] = pickle.load(f)
+            loaded_dict[file.split('.')[0]] = load_pickle(osp.join(save_path, file))
         elif file.endswith('.pt'):
             loaded_dict[file.split('.')[0]] = torch.load(osp.join(save_path, file))
         else:
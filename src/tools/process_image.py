@@ -4,5 +4,34 @@ import matplotlib.pyplot as plt
 
 
 def extract_patch(image, box):
-    x1, y1, x2, y2 = box
-    return image.crop((x1, y1, x2, y2))
\ No newline at end of file
+    return image.crop(tuple(box))
+
+
+def extract_patches(image, boxes):
+    '''
+    Extract patches of the same size from an image in one go.
+    Unlike Image.crop, boxes are not padded, so every box must lie within the image.
+    Args:
+        image (PIL.Image.Image): the image to extract patches from
+        boxes (list): a non-empty (N, 4) list of (x1, y1, x2, y2) boxes with the same width and height
+                      after rounding, where 0 <= x1 < x2 <= width and 0 <= y1 < y2 <= height
+    Return:
+        np.ndarray: the patches stacked into an array of shape (N, H, W, C), or (N, H, W) for single-channel images
+    '''
+    boxes = np.asarray(boxes, dtype=float)
+    if boxes.size == 0:
+        raise ValueError('At least one box is required')
+    if boxes.ndim != 2 or boxes.shape[1] != 4:
+        raise ValueError(f'Boxes must have shape (N, 4), got {boxes.shape}')
+    # round the coordinates like Image.crop does
+    boxes = np.rint(boxes).astype(np.int64)
+    width, height = image.size
+    x1, y1, x2, y2 = boxes.T
+    if not (np.all((0 <= x1) & (x1 < x2) & (x2 <= width)) and 
+            np.all((0 <= y1) & (y1 < y2) & (y2 <= height))):
+        raise ValueError(f'All boxes must lie within the image of size {width}x{height}')
+    sizes = np.unique(boxes[:, 2:] - boxes[:, :2], axis=0)
+    if len(sizes) > 1:
+        raise ValueError('All boxes must have the same width and height')
+    array = np.asarray(image)
+    return np.stack([array[y1:y2, x1:x2] for x1, y1, x2, y2 in boxes])